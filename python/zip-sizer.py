@@ -5,11 +5,22 @@
 # compressed size of large directories. It works by sampling a fraction of
 # the data to efficiently calculate the compression ratio.
 # The sampling fraction can be specified using the --sampling-ratio command line flag.
-# Only uses stdlib modules and does not require any third-party libraries.
+# Does not require any third-party libraries: the modules and executables
+# below are optional and only used when available, falling back to the stdlib.
+# gzip compression uses the fastest module available, in this order: isal (for
+# levels 1-3, ISA-L does not implement higher levels), zlib_ng, pgzip (which
+# uses all cores) and the stdlib gzip. If lbzip2 (executable) is available, it
+# is used to compress bzip2 on all cores.
+# zstd estimates (the default when available) need the zstandard module, or
+# python 3.14+ (which has compression.zstd in the stdlib).
 # This is the python (much slower) version of the original go script, zip-sizer.go
 
 # Usage:
-# python zip-sizer.py <directory> [--algorithm <gzip|bzip2>] [--level <1-9>] [--sampling-ratio <0-1>] [--verbose]
+# python zip-sizer.py <directory> [--algorithm <zstd|gzip|bzip2>] [--level <1-9|fast|balanced|max>] [--sampling-ratio <0-1>]
+#        [--processes <n>] [--early-stop-epsilon <e>] [--sendfile] [--verbose]
+# The default level is 1 (fast): the sample is only compressed to estimate the
+# compression ratio, not to be archived. Pass --level 9 (or max) to estimate
+# the size of a maximally compressed archive.
 # Example:
 # Example usage:
 # python zip-sizer.py /home/$(whoami) --algorithm gzip --level 9 --sampling-ratio 0.1 --verbose
@@ -17,49 +28,256 @@
 import os
 import gzip
 import bz2
+import io
+import stat
 import sys
+import shutil
+import subprocess
+import threading
 import argparse
 import logging
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
 
 CHUNKSIZE = 10 * 1024 * 1024
 
+# number of files read concurrently while sampling
+READ_WORKERS = 32
+
+# bytes of the sample read ahead of the compressor while sampling
+READ_AHEAD_SIZE = 4 * CHUNKSIZE
+
+# size of the independently compressed shards of the sample when compressing
+# in parallel processes; large enough that splitting barely affects the ratio
+SHARD_SIZE = CHUNKSIZE
+
+# A gzip implementation: `open(sink, level)` returns a streaming compressor
+# writing to `sink`, `compress(data, level)` compresses `data` in one go.
+GzipBackend = namedtuple(
+    "GzipBackend", ["name", "open", "compress", "max_level", "multithreaded"]
+)
+
+# the available gzip implementations, fastest first
+GZIP_BACKENDS = []
+
+try:
+    from isal import igzip
+
+    GZIP_BACKENDS.append(
+        GzipBackend(
+            "isal",
+            lambda sink, level: igzip.IGzipFile(
+                fileobj=sink, mode="wb", compresslevel=level
+            ),
+            lambda data, level: igzip.compress(data, compresslevel=level),
+            3,  # ISA-L does not implement higher levels
+            False,
+        )
+    )
+except ImportError:
+    pass
+
+try:
+    from zlib_ng import gzip_ng
+
+    GZIP_BACKENDS.append(
+        GzipBackend(
+            "zlib-ng",
+            lambda sink, level: gzip_ng.GzipNGFile(
+                fileobj=sink, mode="wb", compresslevel=level
+            ),
+            lambda data, level: gzip_ng.compress(data, compresslevel=level),
+            9,
+            False,
+        )
+    )
+except ImportError:
+    pass
+
+try:
+    import pgzip
+
+    GZIP_BACKENDS.append(
+        GzipBackend(
+            "pgzip",
+            lambda sink, level: pgzip.PgzipFile(
+                fileobj=sink,
+                mode="wb",
+                compresslevel=level,
+                thread=os.cpu_count(),
+                blocksize=CHUNKSIZE,
+            ),
+            lambda data, level: pgzip.compress(
+                data, compresslevel=level, thread=os.cpu_count(), blocksize=CHUNKSIZE
+            ),
+            9,
+            True,
+        )
+    )
+except ImportError:
+    pass
+
+GZIP_BACKENDS.append(
+    GzipBackend(
+        "gzip",
+        lambda sink, level: gzip.GzipFile(fileobj=sink, mode="wb", compresslevel=level),
+        lambda data, level: gzip.compress(data, compresslevel=level),
+        9,
+        False,
+    )
+)
+
+LBZIP2 = shutil.which("lbzip2")
+
+# compressor executables usable with --sendfile, preferred first
+COMPRESSOR_COMMANDS = {
+    "zstd": [["zstd", "-q", "-T0"]],
+    "gzip": [["pigz"], ["gzip"]],
+    "bzip2": [["lbzip2"], ["bzip2"]],
+}
+
+# number of consecutive shards whose compression ratio must change by less than
+# --early-stop-epsilon before sampling stops early
+EARLY_STOP_ROUNDS = 5
+
+# posix_fadvise is not available on all platforms (e.g. macOS, Windows)
+HAVE_FADVISE = hasattr(os, "posix_fadvise")
+
+# neither is preadv (e.g. Windows, older macOS); fall back to seek + readinto
+HAVE_PREADV = hasattr(os, "preadv")
+
+ALGORITHMS = ["zstd", "gzip", "bzip2"]
+
+# zstd needs a python module, except with --sendfile (which uses the zstd executable)
+HAVE_ZSTD_MODULE = zstandard is not None or zstd is not None
+DEFAULT_ALGORITHM = "zstd" if HAVE_ZSTD_MODULE else "gzip"
+
+LEVEL_PRESETS = {"fast": 1, "balanced": 6, "max": 9}
+
+
+def walk_files(directory):
+    """
+    Recursively yield `(filepath, filesize)` for every regular file under `directory`.
+    Uses os.scandir, whose entries cache the file type, so directories cost no
+    stat call and files a single lstat. Symbolic links are not followed.
+    Like os.walk, a directory's files are listed before its subdirectories, so
+    the sampled bytes (and the estimate) are the same as with os.walk.
+    """
+    try:
+        entries = list(os.scandir(directory))
+    except OSError as e:
+        logging.warning(f"Error listing directory {directory}: {e}")
+        return
+    subdirectories = []
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+            # the lstat is needed for the size anyway; it also tells regular
+            # files apart from symbolic links, sockets, devices, ...
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISREG(st.st_mode):
+                yield (entry.path, st.st_size)
+        except OSError as e:
+            logging.warning(f"Error getting size of file {entry.path}: {e}")
+    for subdirectory in subdirectories:
+        yield from walk_files(subdirectory)
+
 
 def list_files_with_sizes(directory):
     """
     List all files in a directory and its subdirectories along with their sizes.
     """
-    files_with_sizes = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            filepath = os.path.join(root, file)
-
-            # only count files that are not directories or symbolic links
-            if (
-                not os.path.isfile(filepath)
-                or os.path.isdir(filepath)
-                or os.path.islink(filepath)
-            ):
-                continue
-            try:
-                filesize = os.path.getsize(filepath)
-                files_with_sizes.append((filepath, filesize))
-            except OSError as e:
-                logging.warning(
-                    f"Error getting size of file {filepath}: {e}", file=sys.stderr
-                )
-                continue
-            except FileNotFoundError as e:
-                logging.warning(f"File not found: {filepath}: {e}", file=sys.stderr)
-                continue
-    return files_with_sizes
+    return list(walk_files(directory))
 
 
-def sample_data(files_with_sizes):
+def coalesce(offsets, sample_size):
     """
-    Sample the last `sampling_ratio` fraction of bytes for every `CHUNKSIZE` bytes from the collated data.
+    Merge the `sample_size` byte reads at the sorted `offsets` into `(offset, length)` runs of contiguous reads.
+    """
+    run_offset, run_length = None, 0
+    for offset in offsets:
+        if run_offset is not None and offset == run_offset + run_length:
+            run_length += sample_size
+            continue
+        if run_offset is not None:
+            yield run_offset, run_length
+        run_offset, run_length = offset, sample_size
+    if run_offset is not None:
+        yield run_offset, run_length
+
+
+def read_offsets(filepath, offsets, sample_size):
+    """
+    Read `sample_size` bytes at each of the (sorted) `offsets` in a file and return them concatenated.
+    Adjacent samples are read with a single call.
+    """
+    # the samples are read straight into one preallocated buffer, which is
+    # shrunk at the end if some reads were short (i.e. hit the end of the file)
+    buf = bytearray(len(offsets) * sample_size)
+    nread = 0
+    try:
+        with open(filepath, "rb", buffering=0) as f:
+            fd = f.fileno()
+            # the reads are sparse: tell the kernel not to read ahead, and to
+            # drop the pages from the cache once we are done with the file
+            if HAVE_FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+            with memoryview(buf) as view:
+                for run_offset, run_length in coalesce(offsets, sample_size):
+                    end = nread + run_length
+                    position = run_offset
+                    while nread < end:
+                        if HAVE_PREADV:
+                            # preadv does not move the file position
+                            n = os.preadv(fd, [view[nread:end]], position)
+                        else:
+                            f.seek(position)
+                            n = f.readinto(view[nread:end])
+                        if n == 0:  # end of file
+                            break
+                        nread += n
+                        position += n
+            if HAVE_FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except FileNotFoundError:
+        logging.warning(f"Error: The file '{filepath}' does not exist.")
+    except IOError:
+        logging.warning(f"Error: Unable to read the file '{filepath}'.")
+    except PermissionError:
+        logging.warning(
+            f"Error: Insufficient permissions to read the file '{filepath}'."
+        )
+    except IsADirectoryError:
+        logging.warning(f"Error: '{filepath}' is a directory, not a file.")
+    except TypeError:
+        logging.warning(
+            "Error: Invalid file path type. Expected a string, bytes, or os.PathLike object."
+        )
+    except OSError as e:
+        logging.warning(f"OS error occurred: {e}")
+    del buf[nread:]
+    return buf
+
+
+def sampling_plans(files_with_sizes, total_size):
+    """
+    Plan sampling the last `sampling_ratio` fraction of bytes for every `CHUNKSIZE` bytes from the collated data.
+    Returns the sample size, and `(filepath, offsets)` for every file containing sampling points.
     """
 
-    total_size = sum(size for _, size in files_with_sizes)
     if args.verbose:
         print(f"Total number of files: {len(files_with_sizes)}")
         print(
@@ -70,90 +288,370 @@ def sample_data(files_with_sizes):
     if args.verbose:
         print(f"Sampling {sample_size} bytes from every {CHUNKSIZE} bytes of data.")
 
-    sampled_data = b""
-
-    # Determine sampling points
-    sampling_points = list(range(CHUNKSIZE - sample_size, total_size, CHUNKSIZE))
-
-    # Iterate through files and extract data
+    # The sampling points are at CHUNKSIZE - sample_size + k * CHUNKSIZE in the
+    # collated data. Compute, in one pass, the (sorted) offsets relative to each
+    # file of the sampling points that fall within it.
+    first_point = CHUNKSIZE - sample_size
+    plans = []
     current_offset = 0
     for filepath, filesize in files_with_sizes:
-        # Skip files that don't contain any sampling points
-        if not sampling_points or sampling_points[0] >= current_offset + filesize:
-            current_offset += filesize
-            continue
+        # index of the first sampling point at or after the start of this file
+        k = max(0, -((first_point - current_offset) // CHUNKSIZE))
+        relative_offset = first_point + k * CHUNKSIZE - current_offset
+        if relative_offset < filesize:
+            plans.append((filepath, range(relative_offset, filesize, CHUNKSIZE)))
+        current_offset += filesize
+    return sample_size, plans
+
 
-        # Open the file only if it contains relevant sampling points
+def sample_data(files_with_sizes, total_size):
+    """
+    Sample the last `sampling_ratio` fraction of bytes for every `CHUNKSIZE` bytes from the collated data.
+    Files are read concurrently, `READ_WORKERS` at a time, in batches of about
+    `SHARD_SIZE` bytes, and the batches are yielded in order.
+    """
+    sample_size, plans = sampling_plans(files_with_sizes, total_size)
+    batch_length = max(1, SHARD_SIZE // max(1, sample_size))
+
+    # Read the batches concurrently; the GIL is released during reads, so the
+    # disk latencies overlap. At most 2 * READ_WORKERS batches, and about
+    # READ_AHEAD_SIZE bytes (plus one batch), are kept in flight, however large
+    # the files are; many small files are still read READ_WORKERS at a time.
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        pending = deque()
+        in_flight = 0
         try:
-            with open(filepath, "rb") as f:
-                while (
-                    sampling_points and current_offset + filesize > sampling_points[0]
-                ):
-                    # Calculate relative offset within the current file
-                    relative_offset = sampling_points[0] - current_offset
-                    f.seek(relative_offset)
-                    sampled_data += f.read(sample_size)
-                    sampling_points.pop(0)  # Move to the next sampling point
-
-            current_offset += filesize
-        except FileNotFoundError:
-            logging.warning(f"Error: The file '{filepath}' does not exist.")
-            continue
-        except IOError:
-            logging.warning(f"Error: Unable to read the file '{filepath}'.")
-            continue
-        except PermissionError:
-            logging.warning(
-                f"Error: Insufficient permissions to read the file '{filepath}'."
+            for filepath, offsets in plans:
+                for i in range(0, len(offsets), batch_length):
+                    batch = offsets[i : i + batch_length]
+                    pending.append(
+                        (
+                            len(batch) * sample_size,
+                            executor.submit(read_offsets, filepath, batch, sample_size),
+                        )
+                    )
+                    in_flight += len(batch) * sample_size
+                    while pending and (
+                        len(pending) >= 2 * READ_WORKERS or in_flight >= READ_AHEAD_SIZE
+                    ):
+                        batch_size, future = pending.popleft()
+                        in_flight -= batch_size
+                        yield future.result()
+            while pending:
+                yield pending.popleft()[1].result()
+        finally:
+            # when the consumer stops early, don't read the remaining batches
+            for _, future in pending:
+                future.cancel()
+
+
+class ByteCounter(io.RawIOBase):
+    """
+    A write-only file object that discards what is written to it, only counting the bytes.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        n = memoryview(data).nbytes
+        self.count += n
+        return n
+
+
+class ExternalCompressor:
+    """
+    A write-only file object that pipes what is written to it through an external
+    compressor command, writing the compressed stream to `sink`.
+    """
+
+    def __init__(self, command, sink):
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        # drain stdout concurrently, so the compressor never blocks on a full pipe
+        self.reader = threading.Thread(target=self._drain, args=(sink,))
+        self.reader.start()
+
+    def _drain(self, sink):
+        for block in iter(lambda: self.process.stdout.read(65536), b""):
+            sink.write(block)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def fileno(self):
+        return self.process.stdin.fileno()
+
+    def close(self):
+        self.process.stdin.close()
+        self.reader.join()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(
+                self.process.returncode, self.process.args
             )
-            continue
-        except IsADirectoryError:
-            logging.warning(f"Error: '{filepath}' is a directory, not a file.")
-            continue
-        except TypeError:
-            logging.warning(
-                "Error: Invalid file path type. Expected a string, bytes, or os.PathLike object."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def gzip_backend(level, multithreaded=True):
+    """
+    Return the fastest available gzip backend that supports compression `level`,
+    skipping the multi-threaded ones unless `multithreaded`.
+    """
+    return next(
+        backend
+        for backend in GZIP_BACKENDS
+        if level <= backend.max_level and (multithreaded or not backend.multithreaded)
+    )
+
+
+def open_compressor(sink):
+    """
+    Open a streaming zstd, gzip or bzip2 compressor that writes the compressed stream to `sink`.
+    Uses the multi-threaded zstandard for zstd, the fastest available gzip backend,
+    and the multi-threaded lbzip2 for bzip2, when available.
+    """
+    if args.algorithm == "zstd":
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=args.level, threads=-1).stream_writer(
+                sink
             )
-            continue
-        except OSError as e:
-            logging.warning(f"OS error occurred: {e}")
-            continue
-    return sampled_data
+        return zstd.ZstdFile(sink, "w", level=args.level)
+    elif args.algorithm == "bzip2":
+        if LBZIP2 is not None:
+            return ExternalCompressor([LBZIP2, "-c", f"-{args.level}"], sink)
+        return bz2.BZ2File(sink, "wb", compresslevel=args.level)
+    elif args.algorithm == "gzip":
+        return gzip_backend(args.level).open(sink, args.level)
 
 
-def compress_sampled_data(sampled_data):
+def is_multithreaded():
     """
-    Compress the sampled data using gzip.
+    Whether the compressor used for `args.algorithm` already runs on multiple cores.
     """
-    if args.algorithm == "bzip2":
-        compressed_data = bz2.compress(sampled_data, compresslevel=args.level)
+    if args.algorithm == "zstd":
+        return zstandard is not None
+    elif args.algorithm == "bzip2":
+        return LBZIP2 is not None
     elif args.algorithm == "gzip":
-        compressed_data = gzip.compress(sampled_data, compresslevel=args.level)
+        return gzip_backend(args.level).multithreaded
 
-    if args.verbose:
+
+def compressed_length(data, algorithm, level):
+    """
+    Compress `data` in one go on a single core, and return the size of the compressed data.
+    Runs in the worker processes of compress_in_parallel(), so gets the settings as arguments.
+    """
+    if algorithm == "zstd":
+        if zstandard is not None:
+            return len(zstandard.ZstdCompressor(level=level).compress(data))
+        return len(zstd.compress(data, level=level))
+    elif algorithm == "bzip2":
+        return len(bz2.compress(data, compresslevel=level))
+    return len(gzip_backend(level, multithreaded=False).compress(data, level))
+
+
+def shards(samples):
+    """
+    Regroup the samples into shards of exactly `SHARD_SIZE` bytes (except the last one).
+    Samples are sliced with memoryviews, so a large sample is split over several
+    shards without being copied first.
+    """
+    shard, shard_size = [], 0
+    for sample in samples:
+        view = memoryview(sample)
+        while view:
+            piece = view[: SHARD_SIZE - shard_size]
+            view = view[len(piece) :]
+            shard.append(piece)
+            shard_size += len(piece)
+            if shard_size == SHARD_SIZE:
+                yield b"".join(shard)
+                shard, shard_size = [], 0
+    if shard:
+        yield b"".join(shard)
+
+
+def compress_stream(samples):
+    """
+    Stream the samples through a single compressor, and return the sizes of the
+    sampled data and of the compressed data. The compressed data itself is never kept.
+    """
+    sampled_size = 0
+    sink = ByteCounter()
+    with open_compressor(sink) as compressor:
+        for sample in samples:
+            compressor.write(sample)
+            sampled_size += len(sample)
+    return sampled_size, sink.count
+
+
+def compress_in_parallel(samples, processes, early_stop_epsilon=None):
+    """
+    Compress shards of the samples independently in `processes` worker processes,
+    and return the sizes of the sampled data and of the (summed) compressed shards.
+    If `early_stop_epsilon` is given, stop once the compression ratio of the shards
+    compressed so far has changed by less than it for `EARLY_STOP_ROUNDS` shards in a row.
+    """
+    sampled_size = 0
+    compressed_size = 0
+    ratio = None
+    stable_rounds = 0
+
+    def collect(shard_size, result):
+        # account for a compressed shard; return True once the ratio has converged
+        nonlocal sampled_size, compressed_size, ratio, stable_rounds
+        sampled_size += shard_size
+        compressed_size += result.get()
+        if early_stop_epsilon is None:
+            return False
+        previous_ratio, ratio = ratio, compressed_size / sampled_size
+        if (
+            previous_ratio is not None
+            and abs(ratio - previous_ratio) < early_stop_epsilon
+        ):
+            stable_rounds += 1
+        else:
+            stable_rounds = 0
+        return stable_rounds >= EARLY_STOP_ROUNDS
+
+    with multiprocessing.Pool(processes) as pool:
+        # keep a bounded number of shards in flight, so the sample is not
+        # read into memory faster than it is compressed
+        pending = deque()
+        for shard in shards(samples):
+            pending.append(
+                (
+                    len(shard),
+                    pool.apply_async(
+                        compressed_length, (shard, args.algorithm, args.level)
+                    ),
+                )
+            )
+            if len(pending) >= 2 * processes and collect(*pending.popleft()):
+                break
+        else:
+            while pending:
+                if collect(*pending.popleft()):
+                    break
+    if stable_rounds >= EARLY_STOP_ROUNDS and args.verbose:
         print(
-            f"Compressed sample size: {len(compressed_data)} bytes ({human_readable_size(len(compressed_data))})"
+            f"Compression ratio converged after {sampled_size} bytes ({human_readable_size(sampled_size)}), stopped sampling."
         )
+    return sampled_size, compressed_size
+
+
+def compress_sampled_data(samples):
+    """
+    Compress the samples, and return the sizes of the sampled data and of the compressed data.
+    Unless the compressor is already multi-threaded, the samples are compressed in
+    shards by `args.processes` parallel processes. With --early-stop-epsilon, the
+    samples are always compressed in shards (by single-threaded compressors), whose
+    exact sizes tell when the ratio has converged.
+    """
+    sharded = args.early_stop_epsilon is not None or (
+        args.processes > 1 and not is_multithreaded()
+    )
+    if args.verbose and args.algorithm == "gzip":
         print(
-            f"Original sample size: {len(sampled_data)} bytes ({human_readable_size(len(sampled_data))})"
+            f"gzip backend: {gzip_backend(args.level, multithreaded=not sharded).name}"
+        )
+
+    if sharded:
+        sampled_size, compressed_size = compress_in_parallel(
+            samples, args.processes, args.early_stop_epsilon
         )
-    return len(compressed_data)
+    else:
+        sampled_size, compressed_size = compress_stream(samples)
+    return sampled_size, compressed_size
+
+
+def compressor_command():
+    """
+    Return the command line of the first available compressor executable for `args.algorithm`, or None.
+    """
+    for command in COMPRESSOR_COMMANDS[args.algorithm]:
+        executable = shutil.which(command[0])
+        if executable is not None:
+            return [executable, *command[1:], "-c", f"-{args.level}"]
+    return None
+
+
+def send_samples(files_with_sizes, total_size):
+    """
+    Send the samples straight from the files into a compressor executable with
+    os.sendfile, so they are never copied through python, and return the sizes
+    of the sampled data and of the compressed data.
+    """
+    sample_size, plans = sampling_plans(files_with_sizes, total_size)
+    command = compressor_command()
+    if args.verbose:
+        print(f"Compressor command: {' '.join(command)}")
+
+    sampled_size = 0
+    sink = ByteCounter()
+    with ExternalCompressor(command, sink) as compressor:
+        out_fd = compressor.fileno()
+        for filepath, offsets in plans:
+            try:
+                fd = os.open(filepath, os.O_RDONLY)
+                try:
+                    if HAVE_FADVISE:
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+                    for run_offset, run_length in coalesce(offsets, sample_size):
+                        position, end = run_offset, run_offset + run_length
+                        while position < end:
+                            n = os.sendfile(out_fd, fd, position, end - position)
+                            if n == 0:  # end of file
+                                break
+                            # count what was sent right away, so that an error
+                            # later in the run does not leave it uncounted
+                            sampled_size += n
+                            position += n
+                    if HAVE_FADVISE:
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+            except BrokenPipeError:
+                # the compressor died; close() reports its exit status
+                break
+            except OSError as e:
+                logging.warning(f"Error: Unable to read the file '{filepath}': {e}")
+    return sampled_size, sink.count
 
 
 def main(directory):
     # Step 1: List all files and their sizes
     files_with_sizes = list_files_with_sizes(directory)
+    original_size = sum(size for _, size in files_with_sizes)
 
-    # Step 2: Sample data
-    sampled_data = sample_data(files_with_sizes)
+    # Step 2 and 3: Sample data, streaming it through the compressor
+    if args.sendfile:
+        sampled_size, compressed_size = send_samples(files_with_sizes, original_size)
+    else:
+        sampled_size, compressed_size = compress_sampled_data(
+            sample_data(files_with_sizes, original_size)
+        )
 
-    # Step 3: Compress sampled data
-    compressed_size = compress_sampled_data(sampled_data)
+    if args.verbose:
+        print(
+            f"Compressed sample size: {compressed_size} bytes ({human_readable_size(compressed_size)})"
+        )
+        print(
+            f"Original sample size: {sampled_size} bytes ({human_readable_size(sampled_size)})"
+        )
 
     # Step 4: Calculate compression ratio
-    original_size = sum(size for _, size in files_with_sizes)
     compressed_size = (
-        (float(compressed_size) / len(sampled_data)) * original_size
+        (float(compressed_size) / sampled_size) * original_size
         if original_size > 0
         else 0
     )
@@ -168,12 +666,27 @@ def main(directory):
     print(
         f"Estimated compressed size: {compressed_size:.2f} ({human_readable_size(compressed_size)}) "
     )
+    print(f"Algorithm: {args.algorithm} (level {args.level})")
     print(f"Compression ratio: {(original_size / compressed_size):.2f}")
     print(
         f"---------------------------------------------------------------------------------"
     )
 
 
+def compression_level(value):
+    """
+    Parse a compression level given either as a number or as a preset name.
+    """
+    if value in LEVEL_PRESETS:
+        return LEVEL_PRESETS[value]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid compression level: '{value}' (choose 1-9 or one of {', '.join(LEVEL_PRESETS)})"
+        )
+
+
 def human_readable_size(size):
     """
     Convert a size in bytes to a human-readable format.
@@ -193,16 +706,17 @@ if __name__ == "__main__":
     parser.add_argument("directory", nargs="?", help="Directory to process.")
     parser.add_argument(
         "--algorithm",
-        choices=["gzip", "bzip2"],
-        default="gzip",
-        help="Compression algorithm to use (gzip or bzip2).",
+        choices=ALGORITHMS,
+        default=DEFAULT_ALGORITHM,
+        help=f"Compression algorithm to use ({', '.join(ALGORITHMS)}; zstd needs the zstandard module, python 3.14+ or --sendfile). Default: {DEFAULT_ALGORITHM}.",
     )
     parser.add_argument(
         "--level",
-        type=int,
+        type=compression_level,
         choices=range(1, 10),
-        default=9,
-        help="Compression level (1-9).",
+        default=1,
+        metavar="{1-9,fast,balanced,max}",
+        help="Compression level (1-9, or fast=1, balanced=6, max=9). Default: 1.",
     )
     parser.add_argument(
         "--sampling-ratio",
@@ -210,6 +724,23 @@ if __name__ == "__main__":
         default=0.1,
         help="Sampling ratio (fraction of data to sample, e.g., 0.1 for 10%%).",
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes compressing the sample in parallel, when the compressor is not already multi-threaded (1 to compress it as a single stream). Not used with --sendfile. Default: number of CPUs.",
+    )
+    parser.add_argument(
+        "--early-stop-epsilon",
+        type=float,
+        default=None,
+        help=f"Stop sampling once the compression ratio changes by less than this for {EARLY_STOP_ROUNDS} consecutive shards of {human_readable_size(SHARD_SIZE)} (e.g. 0.005). Files are sampled in directory order, so this favors the first directories. Default: sample everything.",
+    )
+    parser.add_argument(
+        "--sendfile",
+        action="store_true",
+        help="Send the sample straight from the files into a compressor executable (e.g. pigz, gzip, lbzip2, zstd) with sendfile, instead of reading it into python. Linux only; cannot be combined with --processes or --early-stop-epsilon.",
+    )
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     args = parser.parse_args()
 
@@ -222,14 +753,52 @@ if __name__ == "__main__":
         logging.critical("Sampling ratio must be between 0 and 1.")
         sys.exit(1)
 
+    if args.early_stop_epsilon is not None and args.early_stop_epsilon <= 0:
+        logging.critical("Early stop epsilon must be greater than 0.")
+        sys.exit(1)
+
+    if args.processes is not None and args.processes < 1:
+        logging.critical("Number of processes must be at least 1.")
+        sys.exit(1)
+
     if args.level < 1 or args.level > 9:
         logging.critical("Compression level must be between 1 and 9.")
         sys.exit(1)
 
-    if args.algorithm not in ["gzip", "bzip2"]:
-        logging.critical("Invalid compression algorithm. Choose 'gzip' or 'bzip2'.")
+    if args.algorithm not in ALGORITHMS:
+        logging.critical(
+            f"Invalid compression algorithm. Choose one of {', '.join(ALGORITHMS)}."
+        )
         sys.exit(1)
 
+    # elsewhere (e.g. macOS, FreeBSD), sendfile can only write to sockets
+    if args.sendfile and not sys.platform.startswith("linux"):
+        logging.critical("--sendfile is only supported on Linux.")
+        sys.exit(1)
+
+    if args.sendfile and (
+        args.processes is not None or args.early_stop_epsilon is not None
+    ):
+        logging.critical(
+            "--sendfile cannot be combined with --processes or --early-stop-epsilon."
+        )
+        sys.exit(1)
+
+    if args.algorithm == "zstd" and not HAVE_ZSTD_MODULE and not args.sendfile:
+        logging.critical(
+            "zstd needs the zstandard module or python 3.14+ (or --sendfile with the zstd executable)."
+        )
+        sys.exit(1)
+
+    if args.sendfile and compressor_command() is None:
+        logging.critical(
+            f"--sendfile needs one of {', '.join(command[0] for command in COMPRESSOR_COMMANDS[args.algorithm])} on the PATH."
+        )
+        sys.exit(1)
+
+    if args.processes is None:
+        args.processes = os.cpu_count()
+
     if not os.path.isdir(args.directory):
         logging.critical(f"Provided path '{args.directory}' is not a directory.")
         sys.exit(1)